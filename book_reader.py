@@ -2,23 +2,35 @@ import database
 from books_library import *
 from txt_file import *
 
+_books_dir = os.path.join(config.path_for_save, '')  # with trailing separator
+_path_cache = {}  # book_name -> path of book file
+
+
+def _path_for(book_name):
+    file_path = _path_cache.get(book_name)
+    if file_path is None:
+        file_path = _path_cache[book_name] = _books_dir + book_name
+    return file_path
+
 
 class BookReader():
     """Getting text from book and getting books """
 
     def __init__(self):
-        self.db = database.DataBase()
-        self.books_lib = BooksLibrary()
+        self.db = database.get_database()
+        self.books_lib = get_books_library()
 
     def get_next_portion(self, user_id, offset):
         # Return next part of text of the book on filename
         # Do not recognise end of file. Return '/more' in the end of message
-        current_book = self.books_lib.get_current_book(user_id)
-        if current_book == -1:
-            return None  # 'Sorry, did not find you in users.
-        pos = self.books_lib.get_pos(user_id, current_book) + offset
-        file_path = os.path.join(config.path_for_save, current_book)
-        txt_file = TxtFile()
-        text_piece, i = txt_file.read_piece(file_path, pos, config.piece_size)
-        self.books_lib.update_book_pos(user_id, current_book, i + 1)
+        with self.books_lib.read_lock(user_id):
+            current_book = self.books_lib.get_current_book(user_id)
+            if current_book == -1:
+                return None  # 'Sorry, did not find you in users.
+            pos = self.books_lib.get_pos(user_id, current_book) + offset
+            file_path = _path_for(current_book)
+            txt_file = TxtFile()
+            text_piece, i = txt_file.read_piece(file_path, pos,
+                                                config.piece_size)
+            self.books_lib.update_book_pos(user_id, current_book, i + 1)
         return text_piece
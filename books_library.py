@@ -1,101 +1,228 @@
+import atexit
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 from database import *
 
+_POS_FLUSH_SIZE = 64  # buffered positions written to db in one go
+_RARE_DEFAULT = 12
+_RARE_MAP = {
+    '12 раз в день': 12,
+    '6 раз в день': 6,
+    '4 раза в день': 4,
+    '2 раза в день': 2,
+    '1 раз в день': 1,
+}  # keyboard label -> messages per day
+
+
+class UserSettings(object):
+    """cached settings of one user"""
+
+    __slots__ = ('lang', 'rare', 'audio', 'book', 'auto', 'lock', 'read_lock')
+
+    def __init__(self):
+        self.lang = None
+        self.rare = None
+        self.audio = None
+        self.book = None  # -1 if user has no current book
+        self.auto = None  # -1 if auto status is unknown
+        self.lock = threading.Lock()  # one cold load from db at a time
+        self.read_lock = threading.Lock()  # one portion read at a time
+
 
 class BooksLibrary(object):
     """class for manage user books and auto status"""
 
     def __init__(self):
-        self.db = DataBase()
-        self.lang_cache = {}
-        self.rare_cache = {}
-        self.audio_cache = {}
-        self.pos_cache = {}
+        self.db = get_database()
+        self.users = {}  # user_id -> UserSettings
+        self.positions = {}  # (user_id, book_name) -> pos
+        self.pending_pos = {}  # positions not yet written to db
+        self.pos_lock = threading.Lock()
+        self.flush_lock = threading.Lock()  # batches are written one by one
+        self._flush_queued = False
+        # full batch is written aside, readers never wait for db
+        self._flusher = ThreadPoolExecutor(max_workers=1)
+
+    def _settings(self, user_id):
+        settings = self.users.get(user_id)
+        if settings is None:
+            # setdefault keeps one record if two threads meet a new user
+            settings = self.users.setdefault(user_id, UserSettings())
+        return settings
+
+    def _load_state(self, user_id, settings):
+        # one select fills whatever settings are not cached yet
+        state = self.db.get_user_state(user_id)
+        if state is None:
+            state = UserState(None, None, None, None, 'off')
+        if settings.book is None:
+            settings.book = -1 if state.book is None else state.book
+        if settings.auto is None:
+            settings.auto = -1 if state.auto is None else state.auto
+        if settings.lang is None:
+            settings.lang = state.lang
+        if settings.rare is None:
+            settings.rare = state.rare
+        if settings.audio is None:
+            settings.audio = state.audio
 
     def update_current_book(self, user_id, chat_id, book_name):
         lang = self.get_lang(user_id)
         self.db.update_current_book(user_id, chat_id, book_name, lang)
-        pass
+        settings = self._settings(user_id)
+        settings.book = book_name
+        settings.auto = 1
+
+    def add_book(self, user_id, chat_id, book_name):
+        # new book becomes current and starts from the beginning
+        lang = self.get_lang(user_id)
+        self.db.add_book(user_id, chat_id, book_name, lang)
+        settings = self._settings(user_id)
+        settings.book = book_name
+        settings.auto = 1
+        key = (user_id, book_name)
+        with self.pos_lock:
+            self.positions[key] = 0
+            self.pending_pos.pop(key, None)
+
+    def read_lock(self, user_id):
+        # held while position is read and moved on, so webhook and
+        # autosend never send one portion twice
+        return self._settings(user_id).read_lock
 
     def update_book_pos(self, user_id, current_book, new_pos):
-        self.db.update_book_pos(user_id, current_book, new_pos)
-        pass
+        # position is kept in memory and written to db in batches
+        key = (user_id, current_book)
+        with self.pos_lock:
+            self.positions[key] = new_pos
+            self.pending_pos[key] = new_pos
+            full = (len(self.pending_pos) >= _POS_FLUSH_SIZE
+                    and not self._flush_queued)
+            if full:
+                self._flush_queued = True
+        if full:
+            self._flusher.submit(self._background_flush)
+
+    def _background_flush(self):
+        with self.pos_lock:
+            self._flush_queued = False
+        try:
+            self.flush_positions()
+        except Exception:
+            # rows are pending again, next flush retries them
+            logging.exception('Flush of book positions failed')
+
+    def flush_positions(self):
+        with self.flush_lock:
+            with self.pos_lock:
+                if not self.pending_pos:
+                    return
+                batch = self.pending_pos
+                self.pending_pos = {}
+            rows = [(user_id, book_name, pos) for (user_id, book_name), pos
+                    in batch.items()]
+            try:
+                self.db.update_book_pos_many(rows)
+            except Exception:
+                with self.pos_lock:
+                    for key, pos in batch.items():
+                        # keep positions which changed since the batch was taken
+                        if (key not in self.pending_pos
+                                and self.positions.get(key) == pos):
+                            self.pending_pos[key] = pos
+                raise
 
     def switch_auto_staus(self, user_id):
-        self.db.update_auto_status(user_id)
-        pass
+        auto_status = self.db.update_auto_status(user_id)
+        self._settings(user_id).auto = -1 if auto_status is None else auto_status
 
     def update_lang(self, user_id, lang):
         self.db.update_lang(user_id, lang)
-        self.lang_cache[user_id] = lang
-        return 0
+        self._settings(user_id).lang = lang
 
     def update_rare(self, user_id, rare):
-        if rare == '12 раз в день':
-            rare = 12
-        elif rare == '6 раз в день':
-            rare = 6
-        elif rare == '4 раза в день':
-            rare = 4
-        elif rare == '2 раза в день':
-            rare = 2
-        elif rare == '1 раз в день':
-            rare = 1
-        else:
-            rare = 12
+        rare = _RARE_MAP.get(rare, _RARE_DEFAULT)
         self.db.update_rare(user_id, rare)
-        self.rare_cache[user_id] = str(rare)
-        return 0
+        self._settings(user_id).rare = str(rare)
 
     def update_audio(self, user_id, audio):
         self.db.update_audio(user_id, audio)
-        self.audio_cache[user_id] = audio
-        return 0
+        self._settings(user_id).audio = audio
 
     def get_pos(self, user_id, book_name):
-        return self.db.get_pos(user_id, book_name)
+        pos = self.positions.get((user_id, book_name))
+        if pos is None:
+            pos = self.db.get_pos(user_id, book_name)
+        return pos
 
     def get_lang(self, user_id):
-        lang = self.lang_cache.get(user_id, None)
-        if lang is None:
-            lang = self.db.get_lang(user_id)
-            if lang is None:
-                lang = 'ru'
-                self.update_lang(user_id, lang)
-        return lang
+        settings = self._settings(user_id)
+        if settings.lang is None:
+            with settings.lock:
+                if settings.lang is None:
+                    self._load_state(user_id, settings)
+                    if settings.lang is None:
+                        self.update_lang(user_id, 'ru')
+        return settings.lang
 
     def get_rare(self, user_id):
-        rare = self.rare_cache.get(user_id, None)
-        if rare is None:
-            rare = self.db.get_rare(user_id)
-            if rare is None:
-                rare = '12'
-                self.update_rare(user_id, '12 раз в день')
-        return rare
+        settings = self._settings(user_id)
+        if settings.rare is None:
+            with settings.lock:
+                if settings.rare is None:
+                    self._load_state(user_id, settings)
+                    if settings.rare is None:
+                        self.update_rare(user_id, '12 раз в день')
+        return settings.rare
 
     def get_audio(self, user_id):
-        audio = self.audio_cache.get(user_id, None)
-        if audio is None:
-            audio = self.db.get_audio(user_id)
-            if audio is None:
-                audio = 'off'
-                self.update_audio(user_id, audio)
-        return audio
+        settings = self._settings(user_id)
+        if settings.audio is None:
+            with settings.lock:
+                if settings.audio is None:
+                    self._load_state(user_id, settings)
+        return settings.audio
 
     def get_user_books(self, user_id):
+        # new books get their row in db with the first position write
+        self.flush_positions()
         return self.db.get_user_books(user_id)
 
     def get_auto_status(self, user_id):
-        auto_status = self.db.get_auto_status(user_id)
-        if auto_status is None:
-            return -1
-        return auto_status
-
-    def get_users_for_autosend(self):
-        return self.db.get_users_for_autosend()
+        settings = self._settings(user_id)
+        if settings.auto is None:
+            with settings.lock:
+                if settings.auto is None:
+                    self._load_state(user_id, settings)
+        return settings.auto
+
+    def get_users_for_autosend(self, rares=None):
+        # one query for the whole send list, settings go to cache on the way,
+        # if rares is given only users with one of them are listed
+        send_list = []
+        with_unset_rare = rares is not None and str(_RARE_DEFAULT) in rares
+        for user_id, chat_id, lang, rare, audio in self.db.iter_autosend_batch(
+                rares, with_unset_rare):
+            settings = self._settings(user_id)
+            if lang is not None:
+                settings.lang = lang
+            if rare is not None:
+                settings.rare = rare
+            settings.audio = 'on' if audio else 'off'
+            settings.auto = 1
+            send_list.append((user_id, chat_id))
+        return send_list
 
     def get_current_book(self, user_id, format_name=False):
-        current_book = self.db.get_current_book(user_id)
-        if current_book is None:
+        settings = self._settings(user_id)
+        if settings.book is None:
+            with settings.lock:
+                if settings.book is None:
+                    self._load_state(user_id, settings)
+        current_book = settings.book
+        if current_book == -1:
             return -1
         if format_name:
             current_book = self._format_name(current_book, user_id)
@@ -104,7 +231,25 @@ class BooksLibrary(object):
     def _format_name(self, file_name, user_id):
         # Just del user_id and .txt from file_name
         formatted_name = file_name
-        formatted_name = formatted_name.replace(str(user_id) + '_', '')
-        formatted_name = formatted_name.replace('.txt', '')
-        formatted_name = formatted_name.capitalize()
-        return '📖' + formatted_name
+        prefix = str(user_id) + '_'
+        if formatted_name.startswith(prefix):
+            formatted_name = formatted_name[len(prefix):]
+        if formatted_name.endswith('.txt'):
+            formatted_name = formatted_name[:-4]
+        return '📖' + formatted_name.capitalize()
+
+
+_books_library = None
+_books_library_lock = threading.Lock()
+
+
+def get_books_library():
+    # one library per process, so settings cache stays warm across handlers
+    global _books_library
+    if _books_library is None:
+        with _books_library_lock:
+            if _books_library is None:
+                books_library = BooksLibrary()
+                atexit.register(books_library.flush_positions)
+                _books_library = books_library
+    return _books_library
@@ -1,333 +1,278 @@
+import atexit
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from operator import itemgetter
+
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+import psycopg2.pool
 
 import tokens
 
+UserState = namedtuple('UserState', ['book', 'lang', 'auto', 'rare', 'audio'])
+
+_DDL = """
+    CREATE TABLE IF NOT EXISTS books_pos_table (
+    userId INTEGER,
+    bookName TEXT UNIQUE,
+    pos INTEGER);
+    CREATE TABLE IF NOT EXISTS curent_book_table (
+    userId INTEGER PRIMARY KEY,
+    chatId INTEGER,
+    bookName TEXT UNIQUE,
+    isAutoSend INTEGER,
+    lang TEXT,
+    audio BOOLEAN,
+    rare VARCHAR);
+    -- target of the position upsert, also serves lookups by userId;
+    -- pos is included so get_pos is an index-only scan
+    DROP INDEX IF EXISTS books_pos_user_book_idx;
+    CREATE UNIQUE INDEX IF NOT EXISTS books_pos_user_book_pos_idx
+    ON books_pos_table (userId, bookName) INCLUDE (pos);
+    -- only users with auto-sending on, with every column the autosend
+    -- batch reads, so it never touches the table
+    DROP INDEX IF EXISTS curent_book_autosend_idx;
+    CREATE INDEX IF NOT EXISTS curent_book_autosend_cover_idx
+    ON curent_book_table (userId) INCLUDE (chatId, lang, rare, audio)
+    WHERE isAutoSend=1;
+    """
+# schema is complete if the last object of _DDL exists
+_SCHEMA_READY = "SELECT to_regclass('curent_book_autosend_cover_idx') IS NOT NULL;"
+# hot single-row lookups: name -> (argument types, query)
+_LOOKUPS = {
+    'get_user_state': ('integer', 'SELECT bookName, lang, isAutoSend, rare, audio FROM curent_book_table WHERE userId=%s LIMIT 1;'),
+    'get_pos': ('integer, text', 'SELECT pos FROM books_pos_table WHERE userId=%s and bookName=%s LIMIT 1;'),
+}
+
+
+def _numbered(sql):
+    # %s placeholders -> $1, $2, ... for PREPARE
+    parts = sql.split('%s')
+    return parts[0] + ''.join('$%d%s' % (i, part)
+                              for i, part in enumerate(parts[1:], 1))
+
+
+# lookups are parsed and planned once per connection
+_PREPARE = ''.join('PREPARE stmt_{0}({1}) AS {2}\n'.format(name, types, _numbered(sql))
+                   for name, (types, sql) in _LOOKUPS.items())
+_EXECUTE = {name: 'EXECUTE stmt_{0}({1});'.format(name, ', '.join(['%s'] * (types.count(',') + 1)))
+            for name, (types, sql) in _LOOKUPS.items()}
+# PgBouncer in transaction mode does not keep prepared statements,
+# set use_prepare = False in tokens.py behind it
+_USE_PREPARE = getattr(tokens, 'use_prepare', True)
+
+
+class _Connection(psycopg2.extensions.connection):
+    """pooled connection that remembers its prepared statements"""
+
+    prepared = False
+
 
 class DataBase:
     """work with DataBase"""
 
     def __init__(self):
+        # connections are opened once and shared between calls
+        self._schema_ready = False
+        self._pool = psycopg2.pool.ThreadedConnectionPool(
+            minconn=getattr(tokens, 'pool_min', 2),
+            maxconn=getattr(tokens, 'pool_max', 16),
+            user=tokens.user,
+            password=tokens.password,
+            host=tokens.host,
+            port=getattr(tokens, 'port', "5432"),
+            database=tokens.db,
+            connection_factory=_Connection)
+        atexit.register(self._pool.closeall)
         # Create table and DB if they does not exists
-        # conn = sqlite3.connect('books_pos_table.sqlite')
-        conn = psycopg2.connect(user=tokens.user,
-                                password=tokens.password,
-                                host=tokens.host,
-                                port="5432",
-                                database=tokens.db)
-        cursor = conn.cursor()
-        sql = """
-            CREATE TABLE IF NOT EXISTS books_pos_table (
-            userId INTEGER, 
-            bookName TEXT UNIQUE,
-            pos INTEGER);
-            """
-        cursor.execute(sql)
-        sql2 = """
-            CREATE TABLE IF NOT EXISTS curent_book_table (
-            userId INTEGER PRIMARY KEY, 
-            chatId INTEGER,
-            bookName TEXT UNIQUE,
-            isAutoSend INTEGER,
-            lang TEXT,
-            audio BOOLEAN,
-            rare VARCHAR);
-            """
-        cursor.execute(sql2)
-        cursor.close()
-        conn.close()
+        with self._conn() as conn, conn.cursor() as cursor:
+            cursor.execute(_SCHEMA_READY)
+            if not cursor.fetchone()[0]:
+                cursor.execute(_DDL)
+        self._schema_ready = True  # PREPARE needs the tables
 
-    def update_book_pos(self, user_id, book_name, newpos):
-        # Update pos value for user and book
-        conn = psycopg2.connect(user=tokens.user,
-                                password=tokens.password,
-                                host=tokens.host,
-                                port="5432",
-                                database=tokens.db)
-        cursor = conn.cursor()
-        sql = """
-        INSERT INTO books_pos_table (userId, bookName, pos) VALUES({0}, '{1}', {2})
-        ON CONFLICT (bookName) 
-        DO 
-         UPDATE SET pos={2} ;
-        UPDATE books_pos_table SET pos={2} WHERE userId={0} and bookName='{1}';
-        """.format(user_id, book_name, newpos)
-        cursor.execute(sql)
-        conn.commit()
-        cursor.close()
-        conn.close()
-        return 0
+    @contextmanager
+    def _conn(self):
+        # borrow connection from pool, every statement commits by itself
+        conn = self._pool.getconn()
+        try:
+            if not conn.autocommit:
+                conn.autocommit = True
+            if not conn.prepared and self._schema_ready and _USE_PREPARE:
+                with conn.cursor() as cursor:
+                    cursor.execute(_PREPARE)
+                conn.prepared = True
+            yield conn
+        finally:
+            # dead connection is closed, pool opens a new one instead
+            self._pool.putconn(conn, close=bool(conn.closed))
+
+    def _fetch_one(self, name, params):
+        # run one of _LOOKUPS, prepared if connection has it
+        with self._conn() as conn, conn.cursor() as cursor:
+            if conn.prepared:
+                cursor.execute(_EXECUTE[name], params)
+            else:
+                cursor.execute(_LOOKUPS[name][1], params)
+            return cursor.fetchone()
+
+    def update_book_pos_many(self, rows):
+        # Update pos values for list of (user_id, book_name, pos),
+        # a multi-row insert per page
+        with self._conn() as conn, conn.cursor() as cursor:
+            sql = """
+            INSERT INTO books_pos_table (userId, bookName, pos) VALUES %s
+            ON CONFLICT (userId, bookName)
+            DO
+             UPDATE SET pos=EXCLUDED.pos;
+            """
+            psycopg2.extras.execute_values(cursor, sql, rows, page_size=500)
 
     def update_current_book(self, user_id, chat_id, book_name, lang):
         # Update book currently reading by user
-        conn = psycopg2.connect(user=tokens.user,
-                                password=tokens.password,
-                                host=tokens.host,
-                                port="5432",
-                                database=tokens.db)
-        cursor = conn.cursor()
-        sql = """
-        INSERT INTO curent_book_table (userId, chatId, bookName, isAutoSend, lang) VALUES({0}, {1}, '{2}', {3},'{4}')
-        ON CONFLICT (userId) 
-        DO 
-         UPDATE SET chatId={1}, bookName='{2}', isAutoSend={3},lang='{4}';
-        UPDATE curent_book_table SET bookName='{2}', isAutoSend=1, lang ='{4}'  WHERE userId={0};
-        """.format(user_id, chat_id, book_name, 1, lang)
-        cursor.execute(sql)
-        conn.commit()
-        cursor.close()
-        conn.close()
-        return 0
+        with self._conn() as conn, conn.cursor() as cursor:
+            sql = """
+            INSERT INTO curent_book_table (userId, chatId, bookName, isAutoSend, lang) VALUES(%s, %s, %s, 1, %s)
+            ON CONFLICT (userId)
+            DO
+             UPDATE SET chatId=EXCLUDED.chatId, bookName=EXCLUDED.bookName,
+             isAutoSend=EXCLUDED.isAutoSend, lang=EXCLUDED.lang;
+            """
+            cursor.execute(sql, (user_id, chat_id, book_name, lang))
 
-    def update_auto_status(self, user_id):
-        # change status of auto-sending
-        conn = psycopg2.connect(user=tokens.user,
-                                password=tokens.password,
-                                host=tokens.host,
-                                port="5432",
-                                database=tokens.db)
-        cursor = conn.cursor()
+    def add_book(self, user_id, chat_id, book_name, lang):
+        # Make new book current and set its pos to 0 in one round-trip,
+        # statements sent together run in one transaction
+        with self._conn() as conn, conn.cursor() as cursor:
+            sql = """
+            INSERT INTO curent_book_table (userId, chatId, bookName, isAutoSend, lang) VALUES(%s, %s, %s, 1, %s)
+            ON CONFLICT (userId)
+            DO
+             UPDATE SET chatId=EXCLUDED.chatId, bookName=EXCLUDED.bookName,
+             isAutoSend=EXCLUDED.isAutoSend, lang=EXCLUDED.lang;
+            INSERT INTO books_pos_table (userId, bookName, pos) VALUES(%s, %s, 0)
+            ON CONFLICT (userId, bookName)
+            DO
+             UPDATE SET pos=EXCLUDED.pos;
+            """
+            cursor.execute(sql, (user_id, chat_id, book_name, lang,
+                                 user_id, book_name))
 
-        sql = """
-        INSERT INTO curent_book_table (isAutoSend, userId)
-        VALUES(1,{0}) 
-        ON CONFLICT (userId) 
-        DO 
-        UPDATE SET isAutoSend=(select 1-isAutoSend from curent_book_table where userId = {0});
-         """.format(user_id)
-        cursor.execute(sql)
-        conn.commit()
-        cursor.close()
-        conn.close()
-        return 0
+    def update_auto_status(self, user_id):
+        # change status of auto-sending, return new status or None
+        with self._conn() as conn, conn.cursor() as cursor:
+            sql = """
+            INSERT INTO curent_book_table (isAutoSend, userId)
+            VALUES(1, %s)
+            ON CONFLICT (userId)
+            DO
+            UPDATE SET isAutoSend=1-curent_book_table.isAutoSend
+            RETURNING isAutoSend;
+             """
+            cursor.execute(sql, (user_id,))
+            auto_status = cursor.fetchone()[0]
+        return auto_status
 
     def update_lang(self, user_id, lang):
         # change lang for user
-        conn = psycopg2.connect(user=tokens.user,
-                                password=tokens.password,
-                                host=tokens.host,
-                                port="5432",
-                                database=tokens.db)
-        cursor = conn.cursor()
-        sql = """
-        INSERT INTO curent_book_table (lang, userId)
-        VALUES('{0}',{1}) 
-        ON CONFLICT (userId) 
-        DO 
-         UPDATE SET lang='{2}';
-         """.format(lang, user_id, lang)
-        cursor.execute(sql)
-        conn.commit()
-        cursor.close()
-        conn.close()
-        return 0
+        with self._conn() as conn, conn.cursor() as cursor:
+            sql = """
+            INSERT INTO curent_book_table (lang, userId)
+            VALUES(%s, %s)
+            ON CONFLICT (userId)
+            DO
+             UPDATE SET lang=EXCLUDED.lang;
+             """
+            cursor.execute(sql, (lang, user_id))
 
     def update_rare(self, user_id, rare):
         # change lang for user
-        conn = psycopg2.connect(user=tokens.user,
-                                password=tokens.password,
-                                host=tokens.host,
-                                port="5432",
-                                database=tokens.db)
-        cursor = conn.cursor()
-        sql = """
-        INSERT INTO curent_book_table (rare, userId)
-        VALUES('{0}',{1}) 
-        ON CONFLICT (userId) 
-        DO 
-         UPDATE SET rare='{2}';
-         """.format(rare, user_id, rare)
-        cursor.execute(sql)
-        conn.commit()
-        cursor.close()
-        conn.close()
-        return 0
+        with self._conn() as conn, conn.cursor() as cursor:
+            sql = """
+            INSERT INTO curent_book_table (rare, userId)
+            VALUES(%s, %s)
+            ON CONFLICT (userId)
+            DO
+             UPDATE SET rare=EXCLUDED.rare;
+             """
+            cursor.execute(sql, (str(rare), user_id))
 
     def update_audio(self, user_id, audio):
         # change audio for user
-        if audio == 'on':
-            audio = 'true'
-        else:
-            audio = 'false'
-        conn = psycopg2.connect(user=tokens.user,
-                                password=tokens.password,
-                                host=tokens.host,
-                                port="5432",
-                                database=tokens.db)
-        cursor = conn.cursor()
-        sql = """
-         INSERT INTO curent_book_table (audio, userId)
-         VALUES({0},{1}) 
-         ON CONFLICT (userId) 
-         DO 
-          UPDATE SET audio={2};
-          """.format(audio, user_id, audio)
-        cursor.execute(sql)
-        conn.commit()
-        cursor.close()
-        conn.close()
-        return 0
+        audio = (audio == 'on')
+        with self._conn() as conn, conn.cursor() as cursor:
+            sql = """
+             INSERT INTO curent_book_table (audio, userId)
+             VALUES(%s, %s)
+             ON CONFLICT (userId)
+             DO
+              UPDATE SET audio=EXCLUDED.audio;
+              """
+            cursor.execute(sql, (audio, user_id))
 
-    def get_current_book(self, user_id):
-        # get current book of user
-        conn = psycopg2.connect(user=tokens.user,
-                                password=tokens.password,
-                                host=tokens.host,
-                                port="5432",
-                                database=tokens.db)
-        cursor = conn.cursor()
-        sql = """
-        SELECT bookname FROM curent_book_table WHERE userId={0};
-        """.format(user_id)
-        cursor.execute(sql)
-        fetchone = cursor.fetchone()
-        cursor.close()
-        conn.close()
-        if fetchone is None or None in fetchone:
+    def get_user_state(self, user_id):
+        # Return all settings of user from one row, None for no user
+        fetchone = self._fetch_one('get_user_state', (user_id,))
+        if fetchone is None:
             return None
-        return str(fetchone[0])
-
-    def get_auto_status(self, user_id):
-        # return status of auto-sending
-        conn = psycopg2.connect(user=tokens.user,
-                                password=tokens.password,
-                                host=tokens.host,
-                                port="5432",
-                                database=tokens.db)
-        cursor = conn.cursor()
-        sql = """
-            SELECT isAutoSend FROM curent_book_table WHERE userId={0};
-            """.format(user_id)
-        cursor.execute(sql)
-        fetchone = cursor.fetchone()
-        cursor.close()
-        conn.close()
-        if fetchone is None or None in fetchone:
-            res = -1
-        else:
-            res = int(fetchone[0])
-        return res
+        book, lang, auto, rare, audio = fetchone
+        if book is not None:
+            book = str(book)
+        if auto is not None:
+            auto = int(auto)
+        audio = 'on' if audio else 'off'
+        return UserState(book, lang, auto, rare, audio)
 
     def get_user_books(self, user_id):
         # Return all user's books
-        conn = psycopg2.connect(user=tokens.user,
-                                password=tokens.password,
-                                host=tokens.host,
-                                port="5432",
-                                database=tokens.db)
-        cursor = conn.cursor()
-        sql = """
-        SELECT bookName FROM books_pos_table WHERE userId={0};
-        """.format(user_id)
-        cursor.execute(sql)
-        select_res = cursor.fetchall()
-        cursor.close()
-        conn.close()
-        res = list()
-        for item in select_res:
-            res.append(item[0])
-        return res
+        with self._conn() as conn, conn.cursor() as cursor:
+            sql = """
+            SELECT bookName FROM books_pos_table WHERE userId=%s;
+            """
+            cursor.execute(sql, (user_id,))
+            return list(map(itemgetter(0), cursor))
 
-    def get_users_for_autosend(self):
-        # Return all user with auto-sending ON
-        conn = psycopg2.connect(user=tokens.user,
-                                password=tokens.password,
-                                host=tokens.host,
-                                port="5432",
-                                database=tokens.db)
-        cursor = conn.cursor()
-        sql = """
-        SELECT userId, chatId FROM curent_book_table WHERE isAutoSend=1;
-        """
-        cursor.execute(sql)
-        select_res = cursor.fetchall()
-        cursor.close()
-        conn.close()
-        return select_res
+    def iter_autosend_batch(self, rares=None, with_unset_rare=False):
+        # Yield all user with auto-sending ON together with their settings,
+        # only with rare from rares (or no rare at all) if rares is given,
+        # rows come from a server-side cursor in pages of itersize
+        with self._conn() as conn, \
+                conn.cursor(name='autosend_cur', withhold=True) as cursor:
+            cursor.itersize = 1000
+            sql = """
+            SELECT userId, chatId, lang, rare, audio FROM curent_book_table WHERE isAutoSend=1
+            """
+            params = None
+            if rares is not None:
+                sql += " AND (rare = ANY(%s)"
+                if with_unset_rare:
+                    sql += " OR rare IS NULL"
+                sql += ")"
+                params = (list(rares),)
+            cursor.execute(sql + ";", params)
+            yield from cursor
 
     def get_pos(self, user_id, book_name):
         # Return pos value for user and book
-        conn = psycopg2.connect(user=tokens.user,
-                                password=tokens.password,
-                                host=tokens.host,
-                                port="5432",
-                                database=tokens.db)
-        cursor = conn.cursor()
-        sql = """
-        SELECT pos FROM books_pos_table WHERE userId={0} and bookName='{1}';
-        """.format(user_id, book_name)
-        cursor.execute(sql)
-        fetchone = cursor.fetchone()
-        if fetchone is None or None in fetchone:
+        fetchone = self._fetch_one('get_pos', (user_id, book_name))
+        if fetchone is None or fetchone[0] is None:
             res = -1
         else:
             res = int(fetchone[0])
-        cursor.close()
-        conn.close()
         return res
 
-    def get_lang(self, user_id):
-        # Return lang for user
-        conn = psycopg2.connect(user=tokens.user,
-                                password=tokens.password,
-                                host=tokens.host,
-                                port="5432",
-                                database=tokens.db)
-        cursor = conn.cursor()
-        sql = """
-        SELECT lang FROM curent_book_table WHERE userId={0};
-        """.format(user_id)
-        cursor.execute(sql)
-        fetchone = cursor.fetchone()
-        if fetchone is None or None in fetchone:
-            res = None
-        else:
-            res = fetchone[0]
-        cursor.close()
-        conn.close()
-        return res
 
-    def get_rare(self, user_id):
-        # Return lang for user
-        conn = psycopg2.connect(user=tokens.user,
-                                password=tokens.password,
-                                host=tokens.host,
-                                port="5432",
-                                database=tokens.db)
-        cursor = conn.cursor()
-        sql = """
-        SELECT rare FROM curent_book_table WHERE userId={0};
-        """.format(user_id)
-        cursor.execute(sql)
-        fetchone = cursor.fetchone()
-        if fetchone is None or None in fetchone:
-            res = None
-        else:
-            res = fetchone[0]
-        cursor.close()
-        conn.close()
-        return res
+_database = None
+_database_lock = threading.Lock()
 
-    def get_audio(self, user_id):
-        # Return audio for user
-        conn = psycopg2.connect(user=tokens.user,
-                                password=tokens.password,
-                                host=tokens.host,
-                                port="5432",
-                                database=tokens.db)
-        cursor = conn.cursor()
-        sql = """
-        SELECT audio FROM curent_book_table WHERE userId={0};
-        """.format(user_id)
-        cursor.execute(sql)
-        fetchone = cursor.fetchone()
-        if fetchone is None or None in fetchone:
-            res = None
-        else:
-            res = fetchone[0]
-        cursor.close()
-        conn.close()
-        if res:
-            res = 'on'
-        else:
-            res = 'off'
-        return res
+
+def get_database():
+    # one DataBase per process, tables are checked only once
+    global _database
+    if _database is None:
+        with _database_lock:  # first callers must not open two pools
+            if _database is None:
+                _database = DataBase()
+    return _database
@@ -1,19 +1,74 @@
 import ebooklib
-from bs4 import BeautifulSoup as bs
+import lxml.etree as et
+import lxml.html
 from ebooklib import epub
 from markdownify import markdownify as md
 
+# text inside these elements is not a text of book
+_CHAP_BLACKLIST = frozenset(['noscript', 'header', 'html', 'meta', 'head',
+                             'input', 'script'])
+# there may be more elements you don't want, such as "style", etc.
+_ITEM_BLACKLIST = _CHAP_BLACKLIST | {'style'}
+_PRESERVE_SPACE = frozenset(['pre', 'textarea'])
+_ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+
+
+def _parse_doc(content):
+    # epub documents are xhtml, html parser is only for broken ones and
+    # for named entities like &nbsp; which xml parser keeps unresolved
+    # when the xhtml DTD is not loaded. None for empty document
+    if not content.strip():
+        return None
+    try:
+        parser = et.XMLParser(resolve_entities=False, huge_tree=True)
+        root = et.fromstring(content, parser)
+        if next(root.iter(et.Entity), None) is None:
+            return root
+    except et.XMLSyntaxError:
+        pass
+    try:
+        return lxml.html.document_fromstring(content)
+    except et.ParserError:
+        return None  # only comments or doctype
+
+
+def _tag_name(elem):
+    return et.QName(elem).localname
+
+
+def _text_nodes(root, blacklist):
+    # text nodes in document order whose parent is not in blacklist,
+    # whitespace-only ones are collapsed to one char as BeautifulSoup did
+    preformatted = 0
+    for event, elem in et.iterwalk(root, events=('start', 'end', 'comment', 'pi')):
+        texts = []
+        if event == 'start':
+            name = _tag_name(elem)
+            if name in _PRESERVE_SPACE:
+                preformatted += 1
+            if name not in blacklist:
+                texts.append(elem.text)
+        else:
+            if event == 'end' and _tag_name(elem) in _PRESERVE_SPACE:
+                preformatted -= 1
+            parent = elem.getparent()
+            if parent is not None and _tag_name(parent) not in blacklist:
+                if event == 'comment':
+                    texts.append(elem.text)
+                texts.append(elem.tail)
+        for text in texts:
+            if not text:
+                continue
+            if not preformatted and not text.strip(_ASCII_SPACES):
+                text = '\n' if '\n' in text else ' '
+            yield text
+
 
 def chap2text(chap):
-    output = ''
-    soup = bs(chap, 'html.parser')
-    blacklist = ['[document]', 'noscript', 'header', 'html', 'meta', 'head', 'input', 'script', ]
-    # there may be more elements you don't want, such as "style", etc.
-    text = soup.find_all(text=True)
-    for t in text:
-        if t.parent.name not in blacklist:
-            output += '{} '.format(t)
-    return output
+    root = _parse_doc(chap)
+    if root is None:
+        return ''
+    return ''.join(t + ' ' for t in _text_nodes(root, _CHAP_BLACKLIST))
 
 
 def thtml2ttext(thtml):
@@ -24,24 +79,29 @@ def thtml2ttext(thtml):
     return Output
 
 
+def iter_epub_texts(epub_path):
+    # text of every document of epub, parsed one chapter at a time
+    for html in epub2thtml(epub_path):
+        yield chap2text(html)
+
+
 def epub2text(epub_path):
-    chapters = epub2thtml(epub_path)
-    ttext = thtml2ttext(chapters)
-    return ttext
+    return list(iter_epub_texts(epub_path))
 
 
 def epub2thtml(epub_path):
+    # generator of raw html of every document, wrap in list() if needed
     book = epub.read_epub(epub_path)
-    chapters = []
-    for item in book.get_items():
-        if item.get_type() == ebooklib.ITEM_DOCUMENT:
-            chapters.append(item.get_content())
-    return chapters
+    return (item.get_content()
+            for item in book.get_items_of_type(ebooklib.ITEM_DOCUMENT))
 
 
 class EpubReader:
     # reade text from epub file
 
+    __slots__ = ('epub_path', 'book', 'spine_ids', 'item_ids', 'images',
+                 '_item_texts')
+
     def __init__(self, epub_path=''):
         self.epub_path = epub_path
         if epub_path != '':
@@ -49,11 +109,17 @@ class EpubReader:
             self.spine_ids = self._get_spine_ids()
             self.item_ids = self._get_item_ids()
             self.images = self._get_item_images()
-            # sort list of docs ids in order they follow in spine_ids
-            self.item_ids.sort(key=self._sort_by_spine)
+            # sort list of docs ids in order they follow in spine_ids,
+            # epub readers read book in spine order
+            spine_rank = {}
+            for i, sid in enumerate(self.spine_ids):
+                spine_rank.setdefault(sid, i)
+            # items missing from spine rank with the first spine item, as before
+            self.item_ids.sort(key=lambda x: spine_rank.get(x, 0))
+            self._item_texts = self._iter_item_texts()
         else:
             self.book = None
-        pass
+            self._item_texts = iter(())
 
     def _get_item_ids(self):
         item_ids = []
@@ -79,41 +145,25 @@ class EpubReader:
             return ''
         return self.book.toc
 
-    def _sort_by_spine(self, item):
-        # for sorting list of items by list of ids from spine.
-        # epub readers read book in spine order
-        if item not in self.spine_ids:
-            return 0
-        return self.spine_ids.index(item)
-
     def get_next_item_text(self):
-        # return text of next item with type ITEM_DOCUMENT
-        if len(self.item_ids) == 0:
-            return None
-        item_id = self.item_ids.pop(0)
+        # return text of next item with type ITEM_DOCUMENT, None in the end
+        return next(self._item_texts, None)
+
+    def _iter_item_texts(self):
+        for item_id in self.item_ids:
+            yield self._item_text(item_id)
+
+    def _item_text(self, item_id):
         item_doc = self.book.get_item_with_id(item_id)
-        # soup = bs(item_doc.content.decode('utf-8'), "lxml")
-        # return soup.body.get_text()
-        soup = bs(item_doc.content.decode('utf-8'), 'html.parser')
-        blacklist = ['[document]', 'noscript', 'header', 'html', 'meta', 'head', 'input', 'script', 'style']
-        # there may be more elements you don't want, such as "style", etc.
-        text = soup.find_all(text=True)
-        output = ''
-        for t in text:
-            if t.parent.name not in blacklist:
-                output += '{} '.format(t.replace(
-                    'body {padding:0;} img {height: 100%; max-width: 100%;} div {text-align: center; page-break-after: always;}',
-                    '\n')
-                                       .replace('Cover of ', '')
-                                       .replace(
-                    'Cover body { margin: 0; padding:0 } div.cover { text-align: center; text-indent: 0px; margin:0; vertical-align:middle; } img { max-width:100%; height:100%; border: 0; }',
-                    '')
-                                       .replace(
-                    'page {padding: 0pt; margin:0pt} body { text-align: center; padding:0pt; margin: 0pt; }', '')
-                                       .replace(
-                    'Cover @page {padding: 0pt; margin:0pt} body { text-align: center; padding:0pt; margin: 0pt; }',
-                    '').replace('Annotation', '\n')) + "\n"
-        return output
+        root = _parse_doc(item_doc.content)
+        if root is None:
+            return ''
+        output = []
+        for t in _text_nodes(root, _ITEM_BLACKLIST):
+            # css of covers is inside <style>, which is never in text nodes
+            t = t.replace('Cover of ', '').replace('Annotation', '\n')
+            output.append(t + ' \n')
+        return ''.join(output)
 
     def _get_item_images(self):
         images = []
@@ -1,17 +1,86 @@
 import logging
+import multiprocessing
+import os
 import re
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 import config
 from epub_reader import EpubReader
-from text_transliter import TextTransliter
+from text_separator import split_sentences
+from text_transliter import translit_text
 from txt_file import TxtFile
 from pathlib import Path
 import lxml.etree as et
 
+_BAD_FILENAME_CHARS = re.compile(r'[^A-Za-z0-9 _]')
+_SPLIT_WINDOW = 2 * (os.cpu_count() or 1)  # chapters sent to workers at once
+
+_split_pool = None
+_split_pool_broken = False
+_split_pool_lock = threading.Lock()
+
+
+def start_split_pool():
+    # chapters are split to sentences in parallel, punkt is pure python;
+    # workers are forked, spawn would import the bot module once more.
+    # Call it before scheduler, server and executor threads start, only
+    # the log listener thread runs then and workers never log.
+    # None once the pool broke, forking from the running bot is not safe
+    global _split_pool
+    with _split_pool_lock:
+        if _split_pool is None and not _split_pool_broken:
+            _split_pool = ProcessPoolExecutor(
+                max_workers=os.cpu_count(),
+                mp_context=multiprocessing.get_context('fork'))
+            # forking pool starts all its workers on the first task
+            _split_pool.submit(int).result()
+        return _split_pool
+
+
+def _drop_split_pool(pool):
+    # broken pool is not replaced, next books are split in-process
+    global _split_pool, _split_pool_broken
+    with _split_pool_lock:
+        _split_pool_broken = True
+        if _split_pool is pool:
+            _split_pool = None
+    pool.shutdown(wait=False)
+
+
+def _iter_chapter_sentences(book_reader, sent_mode):
+    # sentences of every chapter in book order,
+    # no more than _SPLIT_WINDOW chapters are held in memory
+    pool = _split_pool or start_split_pool()
+    if pool is None:
+        text = book_reader.get_next_item_text()
+        while text is not None:
+            yield split_sentences(text, sent_mode)
+            text = book_reader.get_next_item_text()
+        return
+    pending = deque()
+    try:
+        text = book_reader.get_next_item_text()
+        while text is not None or pending:
+            while text is not None and len(pending) < _SPLIT_WINDOW:
+                pending.append(pool.submit(split_sentences, text, sent_mode))
+                text = book_reader.get_next_item_text()
+            yield pending.popleft().result()
+    except BrokenProcessPool:
+        _drop_split_pool(pool)
+        raise
+    finally:
+        for future in pending:
+            future.cancel()
+
 
 class FileConverter(object):
     """convert file from epub to txt"""
 
+    __slots__ = ('_path_for_save',)
+
     def __init__(self, path_for_save=''):
         # db = database.DataBase()
         logging.basicConfig(filename="sample.log", filemode="w",
@@ -25,7 +94,7 @@ class FileConverter(object):
 
     @staticmethod
     def _make_filename(user_id='', book_title=''):
-        trans_title = TextTransliter(book_title).get_translitet()
+        trans_title = translit_text(book_title)
         trans_title = trans_title.replace(" ", "_").lower()
         filename = str(user_id) + '_' + trans_title
         return filename
@@ -36,53 +105,52 @@ class FileConverter(object):
             book_reader = EpubReader(epub_path)
             book_title = book_reader.get_booktitle()
             # remove special character
-            book_title.isalnum()
             txt_title = self._make_filename(user_id, book_title)
-            txt_title.isalnum()
             txt_title = txt_title.replace("'", "").replace("\\", "")[0:150]
-            txt_title = re.sub('[^A-z0-9 _]', '', txt_title).lower().replace(" ", "_")
+            txt_title = _BAD_FILENAME_CHARS.sub('', txt_title).lower().replace(" ", "_")
             txt_file = TxtFile()
             txt_file.create_file(self._path_for_save, txt_title)
-
-            cur_text = book_reader.get_next_item_text()
-            while cur_text is not None:
-                txt_file.write_text(cur_text, sent_mode)
-                cur_text = book_reader.get_next_item_text()
-            txt_file.stop_writing()
+            try:
+                for sentences in _iter_chapter_sentences(book_reader,
+                                                         sent_mode):
+                    txt_file.write_sentences(sentences)
+                txt_file.stop_writing()
+            except BaseException:
+                txt_file.abort()
+                raise
             return txt_file.get_filename()
         elif epub_path.endswith(".fb2"):
             txt_title = self._make_filename(user_id, Path(epub_path).stem)
-            txt_title.isalnum()
             txt_title = txt_title.replace("'", "").replace("\\", "")[0:150]
             txt_file = TxtFile()
             txt_file.create_file(self._path_for_save, txt_title)
-            with open(epub_path, 'rb') as f_in:
-                check = f_in.read()
-                tree = et.fromstring(check)
+            try:
+                tree = et.parse(epub_path).getroot()
                 ns = {'ns': "http://www.gribuser.ru/xml/fictionbook/2.0"}
                 for bin_eb in tree.xpath('//ns:binary', namespaces=ns):
                     bin_eb.getparent().remove(bin_eb)
                 for bin_ed in tree.xpath('//ns:description', namespaces=ns):
                     bin_ed.getparent().remove(bin_ed)
-                cleart = et.tounicode(tree)
-                cleart = re.sub(r'\<[^>]*\>', '', cleart)
+                # text of book without tags
+                cleart = ''.join(tree.itertext())
                 txt_file.write_text(cleart, sent_mode)
                 txt_file.stop_writing()
+            except BaseException:
+                txt_file.abort()
+                raise
             return txt_file.get_filename()
         elif epub_path.endswith(".txt"):
             txt_title = self._make_filename(user_id, Path(epub_path).stem)
-            txt_title.isalnum()
             txt_title = txt_title.replace("'", "").replace("\\", "")[0:150]
-            txt_title = re.sub('[^A-z0-9 _]', '', txt_title).lower().replace(" ", "_")
+            txt_title = _BAD_FILENAME_CHARS.sub('', txt_title).lower().replace(" ", "_")
             txt_file = TxtFile()
             txt_file.create_file(self._path_for_save, txt_title)
-            with open(epub_path) as fp:
-                line = fp.readline()
-                cnt = 1
-                while line:
-                    print("Line {}: {}".format(cnt, line.strip()))
-                    txt_file.write_text(line, sent_mode)
-                    line = fp.readline()
-                    cnt += 1
-            txt_file.stop_writing()
+            try:
+                with open(epub_path) as fp:
+                    for line in fp:
+                        txt_file.write_text(line, sent_mode)
+                txt_file.stop_writing()
+            except BaseException:
+                txt_file.abort()
+                raise
             return txt_file.get_filename()
\ No newline at end of file
@@ -1,42 +1,69 @@
 import os
+import threading
 
-from pyunpack import Archive
+import requests
+from telebot import apihelper
 
 from text_transliter import *
 
+_BOOK_EXTENSIONS = ('.epub', '.fb2', '.txt')
+_DOWNLOAD_CHUNK = 1 << 16
+_DOWNLOAD_TIMEOUT = (10, 60)  # seconds to connect, seconds between chunks
+_FILE_URL = "https://api.telegram.org/file/bot{0}/{1}"
+
 
 class FileExtractor(object):
     """file from user which has been sent in bot"""
 
+    __slots__ = ()
+
     def __init__(self):
         pass
 
     @staticmethod
     def _get_file_user_sent(telebot, message):
-        # get file and filename which have been sent by user in bot
+        # get file info and filename which have been sent by user in bot
         file_info = telebot.get_file(message.document.file_id)
-        downloaded_file = telebot.download_file(file_info.file_path)
-        filename = TextTransliter(message.document.file_name).get_translitet()
-        return downloaded_file, filename
+        filename = translit_text(message.document.file_name)
+        return file_info, filename
+
+    @staticmethod
+    def _download_file(telebot, file_info, path_for_save):
+        # stream file to disk by chunks, as telebot.download_file does but
+        # without keeping the whole book in memory; file gets its name
+        # only when it is complete
+        file_url = apihelper.FILE_URL or _FILE_URL
+        url = file_url.format(telebot.token, file_info.file_path)
+        session = apihelper.session or requests  # keep-alive one if set
+        # one part file per thread, the same book may come twice at once
+        tmp_path = '{0}.{1}.part'.format(path_for_save, threading.get_ident())
+        try:
+            with session.get(url, proxies=apihelper.proxy, stream=True,
+                             timeout=_DOWNLOAD_TIMEOUT) as response:
+                response.raise_for_status()
+                with open(tmp_path, 'wb') as new_file:
+                    for chunk in response.iter_content(_DOWNLOAD_CHUNK):
+                        new_file.write(chunk)
+            os.replace(tmp_path, path_for_save)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
 
     def local_save_file(self, telebot, message, download_path):
         # save file from user to local folder
-        downloaded_file, filename = self._get_file_user_sent(telebot, message)
-        # todo make it throw regex, ept
-        if filename.find('.zip') != -1:
-            filename.isalnum()
+        file_info, filename = self._get_file_user_sent(telebot, message)
+        if filename.endswith('.zip'):
             path_for_save = os.path.join(download_path, filename)
-            with open(path_for_save, 'wb') as new_file:
-                new_file.write(downloaded_file)
+            self._download_file(telebot, file_info, path_for_save)
+            from pyunpack import Archive  # only archives need it
             Archive(path_for_save).extractall(download_path)
-            return path_for_save.replace(".zip", "")
-        if filename.find('.epub') != -1 or filename.find('.fb2') != -1 or filename.find('.txt') != -1:
-            # remove special character
-            filename.isalnum()
-            # file_from_user = save_file(downloaded_file, path_for_save, filename)
+            return path_for_save[:-len('.zip')]
+        if filename.endswith(_BOOK_EXTENSIONS):
             path_for_save = os.path.join(download_path, filename)
-            with open(path_for_save, 'wb') as new_file:
-                new_file.write(downloaded_file)
+            self._download_file(telebot, file_info, path_for_save)
             return path_for_save
         else:
             return -1  # type error
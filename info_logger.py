@@ -1,20 +1,32 @@
+import atexit
+import functools
 import logging
+import logging.handlers
+import queue
 
 
 class BotLogger(object):
     """ Logs with now time and join all input parameters"""
 
     def __init__(self, level2=logging.INFO):
-
-        logging.basicConfig(filename="log.txt",
-                            format=u'%(levelname)-8s [%(asctime)s]  %(message)s',
-                            level=logging.INFO)
+        # file is written by listener thread, handlers only put to queue
+        file_handler = logging.FileHandler("log.txt")
+        file_handler.setFormatter(logging.Formatter(
+            u'%(levelname)-8s [%(asctime)s]  %(message)s'))
+        log_queue = queue.SimpleQueue()
+        self._listener = logging.handlers.QueueListener(log_queue,
+                                                        file_handler)
+        self._listener.start()
+        atexit.register(self._listener.stop)
+        queue_handler = logging.handlers.QueueHandler(log_queue)
+        queue_handler.setFormatter(logging.Formatter('%(message)s'))
+        logging.basicConfig(handlers=[queue_handler], level=logging.INFO)
 
     @staticmethod
-    def _join_args(*args):
-        tmp_list = []
-        tmp_list.extend(args)
-        return ' '.join(map(str, tmp_list))
+    @functools.lru_cache(maxsize=None)
+    def _join_format(count):
+        # format string joining count arguments with spaces
+        return ' '.join(['%s'] * count)
 
     def log_message(self, message):
         user_id, chat_id = message.from_user.id, message.chat.id
@@ -31,15 +43,8 @@ class BotLogger(object):
                   'Message:', msg)
 
     def info(self, *args):
-        try:
-            log_issue = self._join_args(args)
-            logging.info(log_issue)
-        except Exception as e:
-            pass
+        # message is only built if record is not filtered out
+        logging.info(self._join_format(len(args)), *args)
 
     def error(self, *args):
-        try:
-            log_issue = self._join_args(args)
-            logging.error(log_issue)
-        except Exception as e:
-            pass
+        logging.error(self._join_format(len(args)), *args)
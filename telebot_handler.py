@@ -1,39 +1,92 @@
 import datetime
+import functools
+import hashlib
+import io
+import os
+import signal
 import sys
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson as json  # faster parser when installed
+except ImportError:
+    import json
 
 import flask
+import requests
 import telebot
 from apscheduler.schedulers.background import BackgroundScheduler
-from gtts import gTTS
+from requests.adapters import HTTPAdapter
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
 
 import config
 import tokens
 from book_adder import BookAdder
 from book_reader import BookReader
-from books_library import BooksLibrary
+from books_library import get_books_library
+from dir_creator import DirCreator
+from file_converter import start_split_pool
 from file_extractor import FileExtractor
 from info_logger import BotLogger
 
 secret = "GUID"
 
+is_prod = '--prod' in sys.argv
+
 token = tokens.test_token
-if '--prod' in sys.argv:
+if is_prod:
     token = tokens.production_token
 
 webhook_host = tokens.ruvds_server_ip  # server ruvds
 webhook_url_base = "https://%s:%s" % (webhook_host, config.webhook_port)
 webhook_url_path = "/%s/" % token
 
+# telebot keeps a session per thread, but flask serves every webhook call
+# in a new thread, so one shared session keeps connections to telegram alive
+_api_session = requests.Session()
+_api_session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=16))
+telebot.apihelper.session = _api_session
+
 # tb = telebot.TeleBot(token, threaded=False)
 tb = telebot.TeleBot(token, threaded=False)
-tb.remove_webhook()
-time.sleep(1)
-tb.set_webhook(url=webhook_url_base + webhook_url_path,
-               certificate=open(config.webhook_ssl_cert, 'r'))
+webhook_info = tb.get_webhook_info()
+# restart keeps webhook which telegram already has
+if (webhook_info.url != webhook_url_base + webhook_url_path
+        or not webhook_info.has_custom_certificate):
+    tb.remove_webhook()
+    time.sleep(1)
+    with open(config.webhook_ssl_cert, 'rb') as cert:
+        tb.set_webhook(url=webhook_url_base + webhook_url_path,
+                       certificate=cert)
 
 app = flask.Flask(__name__)
+UPDATE_WORKERS = 8
+# one thread per worker, updates of a chat always go to the same one,
+# so they run in order and next step handlers keep working
+_update_workers = [ThreadPoolExecutor(max_workers=1)
+                   for _ in range(UPDATE_WORKERS)]
+
+
+def _update_chat_id(update):
+    # chat of update, 0 for kinds which are not bound to a chat
+    if update.message is not None:
+        return update.message.chat.id
+    call = update.callback_query
+    if call is not None:
+        if call.message is not None:
+            return call.message.chat.id
+        return call.from_user.id
+    return 0
+
+
+def process_update(update):
+    try:
+        tb.process_new_updates([update])
+    except Exception as e:
+        logger.error(e)
 
 
 # Empty webserver index, return nothing, just http 200
@@ -46,9 +99,12 @@ def index():
 @app.route(webhook_url_path, methods=['POST'])
 def webhook():
     if flask.request.headers.get('content-type') == 'application/json':
-        json_string = flask.request.get_data().decode('utf-8')
-        update = telebot.types.Update.de_json(json_string)
-        tb.process_new_updates([update])
+        # de_json takes parsed dict as is, so the faster parser is used
+        update = telebot.types.Update.de_json(
+            json.loads(flask.request.get_data()))
+        # answer telegram at once, handlers may wait for db and gTTS
+        worker = _update_workers[_update_chat_id(update) % UPDATE_WORKERS]
+        worker.submit(process_update, update)
         return ''
     else:
         flask.abort(403)
@@ -57,7 +113,7 @@ def webhook():
 # init classes
 book_reader = BookReader()
 book_adder = BookAdder()
-books_library = BooksLibrary()
+books_library = get_books_library()
 commands = ['/help', '/more', '/skip', '/auto_status', '/now_reading', '/change_lang', '/audio', '/rare']
 lang_list = ['en', 'ru']
 rare_list = ['12 раз в день', '6 раз в день', '4 раза в день', '2 раза в день', '1 раз в день']
@@ -66,9 +122,29 @@ logger = BotLogger()
 logger.info('Telebot has been started')
 
 poem_mode_user_id_list = set()  # set of user_id which choose poem_mode before sending a book file
+poem_mode_lock = threading.Lock()  # guards poem_mode_user_id_list
+
 
+def _reply_errors(handler=None, log=True):
+    # reply to user with error of message handler instead of raising it
+    def decorator(handler):
+        @functools.wraps(handler)
+        def wrapper(message):
+            try:
+                return handler(message)
+            except Exception as e:
+                tb.reply_to(message, e)
+                if log:
+                    logger.error(e)
+        return wrapper
+    if handler is not None:
+        return decorator(handler)
+    return decorator
 
+
+@functools.lru_cache(maxsize=None)
 def gen_markup():
+    # same keyboard for every message, so it is built once
     keyboard_markup = InlineKeyboardMarkup()
     keyboard_markup.row_width = 1
     keyboard_markup.add(InlineKeyboardButton("More", callback_data="some_more"))
@@ -86,58 +162,58 @@ def markup(clist):
     return user_markup
 
 
+# keyboards do not change, so they are built once
 user_markup_normal = markup(commands)
+user_markup_remove = markup([])
+user_markup_help = markup(['/help'])
+user_markup_more_help = markup(['/more', '/help'])
+user_markup_auto_on = markup(['/more', '/help', '/stop_auto'])
+user_markup_auto_off = markup(['/more', '/help', '/start_auto'])
+user_markup_start_auto = markup(['/start_auto'])
+user_markup_lang = markup(lang_list)
+user_markup_rare = markup(rare_list)
+user_markup_audio = markup(audio_list)
 
 
 @tb.message_handler(commands=['start'])
+@_reply_errors
 def start_handler(message):
-    try:
-        user_id, chat_id = message.from_user.id, message.chat.id
-        logger.log_message(message)
-        lang = books_library.get_lang(user_id)
-        msg = config.message_success_start[lang]
-        tb.send_message(chat_id, msg,
-                        reply_markup=markup(['/help']))
-        logger.log_sent(user_id, chat_id, msg)
-    except Exception as e:
-        tb.reply_to(message, e)
-        logger.error(e)
+    user_id, chat_id = message.from_user.id, message.chat.id
+    logger.log_message(message)
+    lang = books_library.get_lang(user_id)
+    msg = config.message_success_start[lang]
+    tb.send_message(chat_id, msg,
+                    reply_markup=user_markup_help)
+    logger.log_sent(user_id, chat_id, msg)
 
 
 @tb.message_handler(commands=['auto_status'])
+@_reply_errors(log=False)
 def view_autostatus(message):
-    try:
-        user_id, chat_id = message.from_user.id, message.chat.id
-        lang = books_library.get_lang(user_id)
-        # logger.log_message(message)
-        # 1 means auto is ON
-        is_auto_ON = (books_library.get_auto_status(user_id) == 1)
-        markup_list = ['/more', '/help']
-        if is_auto_ON:
-            markup_list.append('/stop_auto')
-            msg = config.message_everyday_ON[lang]
-        else:
-            markup_list.append('/start_auto')
-            msg = config.message_everyday_OFF[lang]
-        tb.send_message(chat_id, msg, reply_markup=markup(markup_list))
-        # logger.log_sent(user_id, chat_id, msg)
-    except Exception as e:
-        tb.reply_to(message, e)
-        # logger.error(e)
+    user_id, chat_id = message.from_user.id, message.chat.id
+    lang = books_library.get_lang(user_id)
+    # logger.log_message(message)
+    # 1 means auto is ON
+    is_auto_ON = (books_library.get_auto_status(user_id) == 1)
+    if is_auto_ON:
+        user_markup = user_markup_auto_on
+        msg = config.message_everyday_ON[lang]
+    else:
+        user_markup = user_markup_auto_off
+        msg = config.message_everyday_OFF[lang]
+    tb.send_message(chat_id, msg, reply_markup=user_markup)
+    # logger.log_sent(user_id, chat_id, msg)
 
 
 @tb.message_handler(commands=['stop_auto', 'start_auto'])
+@_reply_errors
 def change_autostatus(message):
-    try:
-        user_id, chat_id = message.from_user.id, message.chat.id
-        # 1 means auto is ON
-        logger.log_message(message)
-        if switch_needed(message):
-            books_library.switch_auto_staus(user_id)
-        view_autostatus(message)
-    except Exception as e:
-        tb.reply_to(message, e)
-        logger.error(e)
+    user_id, chat_id = message.from_user.id, message.chat.id
+    # 1 means auto is ON
+    logger.log_message(message)
+    if switch_needed(message):
+        books_library.switch_auto_staus(user_id)
+    view_autostatus(message)
 
 
 def switch_needed(message):
@@ -172,50 +248,47 @@ def books_list_message(books_list, user_id):
     lang = books_library.get_lang(user_id)
     if len(books_list) == 0:
         msg = config.message_empty_booklist[lang]
-        return msg, markup(['/help'])
-    msg = str(config.message_booklist[lang])
+        return msg, user_markup_help
+    prefix = str(user_id) + '_'
+    msg_parts = [str(config.message_booklist[lang])]
     markup_list = []
     for book in books_list:
-        msg += '\t' + str(book).replace(str(user_id) + '_', '') + '\n'
-        markup_list.append('/' + str(book).replace(str(user_id) + '_', ''))
-    msg += str(config.message_choose_book[lang])
-    return msg, markup(markup_list)
+        book = str(book)
+        if book.startswith(prefix):
+            book = book[len(prefix):]
+        msg_parts.append('\t' + book + '\n')
+        markup_list.append('/' + book)
+    msg_parts.append(str(config.message_choose_book[lang]))
+    return ''.join(msg_parts), markup(markup_list)
 
 
+@_reply_errors
 def process_change_book(message):
-    try:
-        user_id, chat_id = message.from_user.id, message.chat.id
-        lang = books_library.get_lang(user_id)
-        new_book = message.text.replace('/', '')
-        new_book = str(user_id) + '_' + new_book
-        tb.send_chat_action(chat_id, 'typing')
-        books_list = books_library.get_user_books(user_id)
-        if new_book in books_list:
-            books_library.update_current_book(user_id, chat_id, new_book)
-            book_name = books_library.get_current_book(user_id,
-                                                       format_name=True)
-            msg = config.message_now_reading[lang].format(book_name)
-            tb.send_message(chat_id, msg,
-                            reply_markup=markup(['/more', '/help']))
-            logger.log_sent(user_id, chat_id, msg)
-        else:
-            msg = config.error_book_recognition[lang]
-            tb.send_message(chat_id, msg)
-            logger.log_sent(user_id, chat_id, msg)
-    except Exception as e:
-        tb.reply_to(message, e)
-        logger.error(e)
+    user_id, chat_id = message.from_user.id, message.chat.id
+    lang = books_library.get_lang(user_id)
+    new_book = str(user_id) + '_' + message.text.replace('/', '')
+    tb.send_chat_action(chat_id, 'typing')
+    books_list = books_library.get_user_books(user_id)
+    if new_book in books_list:
+        books_library.update_current_book(user_id, chat_id, new_book)
+        book_name = books_library.get_current_book(user_id,
+                                                   format_name=True)
+        msg = config.message_now_reading[lang].format(book_name)
+        tb.send_message(chat_id, msg,
+                        reply_markup=user_markup_more_help)
+        logger.log_sent(user_id, chat_id, msg)
+    else:
+        msg = config.error_book_recognition[lang]
+        tb.send_message(chat_id, msg)
+        logger.log_sent(user_id, chat_id, msg)
 
 
 @tb.message_handler(commands=['more'])
+@_reply_errors(log=False)
 def listener(message):
-    try:
-        user_id, chat_id = message.from_user.id, message.chat.id
-        # logger.log_message(message)
-        send_portion(user_id, chat_id, 0)
-    except Exception as e:
-        tb.reply_to(message, e)
-        # logger.error(e)
+    user_id, chat_id = message.from_user.id, message.chat.id
+    # logger.log_message(message)
+    send_portion(user_id, chat_id, 0)
 
 
 @tb.callback_query_handler(func=lambda call: True)
@@ -232,56 +305,44 @@ def callback_query(call):
 
 
 @tb.message_handler(commands=['skip'])
+@_reply_errors(log=False)
 def listener(message):
-    try:
-        user_id, chat_id = message.from_user.id, message.chat.id
-        # logger.log_message(message)
-        send_portion(user_id, chat_id, 100)
-    except Exception as e:
-        tb.reply_to(message, e)
-        # logger.error(e)
+    user_id, chat_id = message.from_user.id, message.chat.id
+    # logger.log_message(message)
+    send_portion(user_id, chat_id, 100)
 
 
 @tb.message_handler(commands=['help'])
+@_reply_errors
 def help_handler(message):
-    try:
-        user_id, chat_id = message.from_user.id, message.chat.id
-        logger.log_message(message)
-        tb.send_chat_action(chat_id, 'typing')
-        lang = books_library.get_lang(user_id)
-        msg = config.message_help[lang]
-        tb.send_message(chat_id, msg, reply_markup=user_markup_normal)
-        logger.log_sent(user_id, chat_id, msg)
-    except Exception as e:
-        tb.reply_to(message, e)
-        logger.error(e)
+    user_id, chat_id = message.from_user.id, message.chat.id
+    logger.log_message(message)
+    tb.send_chat_action(chat_id, 'typing')
+    lang = books_library.get_lang(user_id)
+    msg = config.message_help[lang]
+    tb.send_message(chat_id, msg, reply_markup=user_markup_normal)
+    logger.log_sent(user_id, chat_id, msg)
 
 
 @tb.message_handler(commands=['sayhi'])
+@_reply_errors
 def sayhi_handler(message):
-    try:
-        user_id, chat_id = message.from_user.id, message.chat.id
-        logger.log_message(message)
-        tb.send_message(chat_id, 'Hi sir!')
-        logger.log_sent(user_id, chat_id, 'Hi sir!')
-    except Exception as e:
-        tb.reply_to(message, e)
-        logger.error(e)
+    user_id, chat_id = message.from_user.id, message.chat.id
+    logger.log_message(message)
+    tb.send_message(chat_id, 'Hi sir!')
+    logger.log_sent(user_id, chat_id, 'Hi sir!')
 
 
 @tb.message_handler(commands=['now_reading'])
+@_reply_errors
 def now_reading_handler(message):
-    try:
-        user_id, chat_id = message.from_user.id, message.chat.id
-        tb.send_chat_action(chat_id, 'typing')
-        logger.log_message(message)
-        book_name = now_reading_answer(user_id)
-        tb.send_message(chat_id, book_name,
-                        reply_markup=user_markup_normal)
-        logger.log_sent(user_id, chat_id, book_name)
-    except Exception as e:
-        tb.reply_to(message, e)
-        logger.error(e)
+    user_id, chat_id = message.from_user.id, message.chat.id
+    tb.send_chat_action(chat_id, 'typing')
+    logger.log_message(message)
+    book_name = now_reading_answer(user_id)
+    tb.send_message(chat_id, book_name,
+                    reply_markup=user_markup_normal)
+    logger.log_sent(user_id, chat_id, book_name)
 
 
 def now_reading_answer(user_id):
@@ -296,38 +357,36 @@ def now_reading_answer(user_id):
 
 def _get_user_send_mode(user_id):
     user_send_mode = 'by_sense'
-    if user_id in poem_mode_user_id_list:
-        # if user set poem_mode, remember it and delete from query
-        user_send_mode = 'by_newline'
-        poem_mode_user_id_list.remove(user_id)
+    with poem_mode_lock:
+        if user_id in poem_mode_user_id_list:
+            # if user set poem_mode, remember it and delete from query
+            user_send_mode = 'by_newline'
+            poem_mode_user_id_list.discard(user_id)
     return user_send_mode
 
 
 # maybe once you could make it better
 # @bot.message_handler(func=lambda message: message.document.mime_type == 'text/plain', content_types=['document'])
 @tb.message_handler(content_types=['document'])
+@_reply_errors
 def handle_document(message):
-    try:
-        user_id, chat_id = message.from_user.id, message.chat.id
-        logger.log_message(message)
-        lang = books_library.get_lang(user_id)
-        path_for_save = config.path_for_save
-        file_extractor = FileExtractor()
-        tb.send_chat_action(chat_id, 'typing')
-        local_file_path = file_extractor.local_save_file(tb, message,
-                                                         path_for_save)
-        if local_file_path != -1:
-            book_adder.add_new_book(user_id, chat_id, local_file_path,
-                                    sending_mode="by_sense")
-            msg = config.message_file_added[lang]
-            tb.send_message(chat_id, msg, reply_markup=markup([]))
-            logger.log_sent(user_id, chat_id, msg)
-        else:
-            msg = config.error_file_type[lang]
-            tb.send_message(chat_id, msg)
-    except Exception as e:
-        tb.reply_to(message, e)
-        logger.error(e)
+    user_id, chat_id = message.from_user.id, message.chat.id
+    logger.log_message(message)
+    lang = books_library.get_lang(user_id)
+    path_for_save = config.path_for_save
+    file_extractor = FileExtractor()
+    tb.send_chat_action(chat_id, 'typing')
+    local_file_path = file_extractor.local_save_file(tb, message,
+                                                     path_for_save)
+    if local_file_path != -1:
+        book_adder.add_new_book(user_id, chat_id, local_file_path,
+                                sending_mode="by_sense")
+        msg = config.message_file_added[lang]
+        tb.send_message(chat_id, msg, reply_markup=user_markup_remove)
+        logger.log_sent(user_id, chat_id, msg)
+    else:
+        msg = config.error_file_type[lang]
+        tb.send_message(chat_id, msg)
 
 
 @tb.message_handler(commands=['change_lang'])
@@ -335,7 +394,7 @@ def change_lang_handler(message):
     user_id, chat_id = message.from_user.id, message.chat.id
     logger.log_message(message)
     msg = 'Choose language on keyboard\n'
-    tb.send_message(chat_id, msg, reply_markup=markup(lang_list))
+    tb.send_message(chat_id, msg, reply_markup=user_markup_lang)
     logger.log_sent(user_id, chat_id, msg)
     tb.register_next_step_handler(message, change_lang)
 
@@ -346,7 +405,7 @@ def set_rare_mode(message):
     logger.log_message(message)
     msg = 'Выберите как часто бот будет отправлять вам сообщения, сейчас отправка происходит {0} раз в день.'.format(
                  books_library.get_rare(user_id))
-    tb.send_message(chat_id, msg, reply_markup=markup(rare_list))
+    tb.send_message(chat_id, msg, reply_markup=user_markup_rare)
     logger.log_sent(user_id, chat_id, msg)
     tb.register_next_step_handler(message, change_rare)
 
@@ -356,7 +415,7 @@ def change_lang_handler(message):
     user_id, chat_id = message.from_user.id, message.chat.id
     logger.log_message(message)
     msg = 'Включить или выключить режим аудиокниги\n'
-    tb.send_message(chat_id, msg, reply_markup=markup(audio_list))
+    tb.send_message(chat_id, msg, reply_markup=user_markup_audio)
     logger.log_sent(user_id, chat_id, msg)
     tb.register_next_step_handler(message, change_audio)
 
@@ -409,12 +468,15 @@ def command_default(message):
     logger.log_sent(user_id, chat_id, msg)
 
 
+# end_book_string is the last line of every converted book,
+# so only the tail of portion needs to be checked
+_end_book_tail = len(config.end_book_string) + 16
+
+
 def book_finished(portion):
-    if config.end_book_string in portion:
-        return True
     if portion == '/more':
         return True
-    return False
+    return portion[-_end_book_tail:].rstrip().endswith(config.end_book_string)
 
 
 def turn_off_autostatus(user_id, chat_id):
@@ -423,13 +485,128 @@ def turn_off_autostatus(user_id, chat_id):
         books_library.switch_auto_staus(user_id)
         lang = books_library.get_lang(user_id)
         auto_off_msg = config.message_everyday_OFF[lang]
-        user_markup = markup(['/start_auto'])
-        tb.send_message(chat_id, auto_off_msg, reply_markup=user_markup)
+        tb.send_message(chat_id, auto_off_msg,
+                        reply_markup=user_markup_start_auto)
+
+
+VOICE_CACHE_SIZE = 32  # how many voiced messages keep in memory
+VOICE_DISK_LIMIT = 500 * 1024 * 1024  # bytes of voices kept in voices dir
+_voices = OrderedDict()  # digest of lang and text -> mp3 bytes of it
+_voices_lock = threading.Lock()
+_voice_files = OrderedDict()  # path of voice file -> its size, oldest first
+_voice_files_size = 0
+# gTTS waits for Google, so voice is rendered and sent outside of webhook
+_voice_pool = ThreadPoolExecutor(max_workers=4)
+
+
+def _index_voice_files():
+    # voices rendered before restart stay in cache, oldest are evicted first
+    global _voice_files_size
+    DirCreator(config.path_for_voices)
+    entries = []
+    for entry in os.scandir(config.path_for_voices):
+        if not entry.is_file():
+            continue
+        if entry.name.endswith('.mp3'):
+            entries.append(entry)
+        elif entry.name.endswith('.tmp'):
+            # left by a write interrupted before restart
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+    entries.sort(key=lambda entry: entry.stat().st_mtime)
+    for entry in entries:
+        size = entry.stat().st_size
+        _voice_files[entry.path] = size
+        _voice_files_size += size
+
+
+_index_voice_files()
+
+
+def _store_voice_file(voice_path, voice):
+    # caller holds _voices_lock
+    global _voice_files_size
+    # partly written voice must never be indexed or sent
+    tmp_path = '{0}.{1}.{2}.tmp'.format(voice_path, os.getpid(),
+                                        threading.get_ident())
+    try:
+        with open(tmp_path, 'wb') as voice_file:
+            voice_file.write(voice)
+        os.replace(tmp_path, voice_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    _voice_files[voice_path] = len(voice)
+    _voice_files_size += len(voice)
+    while _voice_files_size > VOICE_DISK_LIMIT and len(_voice_files) > 1:
+        old_path, old_size = _voice_files.popitem(last=False)
+        _voice_files_size -= old_size
+        try:
+            os.remove(old_path)
+        except OSError:
+            pass
+
+
+def _forget_voice_file(voice_path):
+    # forget voice file which was removed behind our back
+    global _voice_files_size
+    _voice_files_size -= _voice_files.pop(voice_path, 0)
+
+
+def get_voice(text, lang='ru'):
+    # voice of message text, the same portions are sent to many users,
+    # so voices are kept in memory and on disk between restarts
+    key = hashlib.blake2b('{0}|{1}'.format(lang, text).encode('utf-8'),
+                          digest_size=16).hexdigest()
+    voice_path = os.path.join(config.path_for_voices, key + '.mp3')
+    with _voices_lock:
+        voice = _voices.get(key)
+        if voice is not None:
+            _voices.move_to_end(key)
+            return voice
+        if voice_path in _voice_files:
+            _voice_files.move_to_end(voice_path)
+            try:
+                with open(voice_path, 'rb') as voice_file:
+                    voice = voice_file.read()
+            except OSError:
+                voice = None
+                _forget_voice_file(voice_path)
+    if voice is None:
+        from gtts import gTTS  # only audio mode needs it
+        buf = io.BytesIO()
+        gTTS(text, lang=lang).write_to_fp(buf)
+        voice = buf.getvalue()
+    with _voices_lock:
+        if voice_path not in _voice_files:
+            try:
+                _store_voice_file(voice_path, voice)
+            except OSError as e:
+                logger.error(e)
+        _voices[key] = voice
+        if len(_voices) > VOICE_CACHE_SIZE:
+            _voices.popitem(last=False)
+    return voice
+
+
+def send_voices(chat_id, texts):
+    # voice every part of one portion in order, runs in _voice_pool
+    try:
+        for text in texts:
+            voice = io.BytesIO(get_voice(text))
+            tb.send_voice(chat_id, voice, disable_notification=True)
+    except Exception as e:
+        logger.error(e)
 
 
 def send_portion(user_id, chat_id, offset):
-    logger.info('Sending action TYPING: ', user_id, chat_id)
-    tb.send_chat_action(chat_id, 'typing')
+    # no 'typing' action: the portion is read from a local mmap and
+    # its message replaces the indicator right away
     msg = book_reader.get_next_portion(user_id, offset)
     lang = books_library.get_lang(user_id)
     res = 0
@@ -444,51 +621,55 @@ def send_portion(user_id, chat_id, offset):
     # msg += '\n/more'
     m_size = config.max_msg_size  # max message size
     audio = books_library.get_audio(user_id)
-    while len(msg) > 0:
-        logger.info('Send to u_id, c_id: ', user_id, chat_id, 'Message:', msg)
-        tb.send_message(chat_id, msg[:m_size], reply_markup=gen_markup(), parse_mode='Markdown')
-        # tb.send_message(chat_id, msg[:m_size], reply_markup=markup([]), parse_mode='Markdown')
+    voice_texts = []
+    for start in range(0, len(msg), m_size):
+        msg_part = msg[start:start + m_size]
+        logger.info('Send to u_id, c_id: ', user_id, chat_id, 'Message:', msg_part)
+        tb.send_message(chat_id, msg_part, reply_markup=gen_markup(), parse_mode='Markdown')
+        # tb.send_message(chat_id, msg_part, reply_markup=markup([]), parse_mode='Markdown')
         if audio == 'on':
-            tts = gTTS(msg[:m_size], lang='ru')
-            tts.save(str(chat_id) + '.ogg')
-            audio = open(str(chat_id) + '.ogg', 'rb')
-            tb.send_voice(chat_id, audio, disable_notification=True)
-        msg = msg[m_size:]
+            voice_texts.append(msg_part)
+    if voice_texts:
+        _voice_pool.submit(send_voices, chat_id, voice_texts)
     logger.info('OK')
     return res
 
 
+# how_rare -> hours when portion is sent, '12' goes out on every run
+SEND_HOURS = {
+    '12': frozenset(range(24)),
+    '6': frozenset({5, 7, 9, 11, 13, 15, 17}),
+    '4': frozenset({5, 9, 15, 17}),
+    '2': frozenset({9, 15}),
+    '1': frozenset({9}),
+}
+
+
 def auto_send_portions():
-    send_list = books_library.get_users_for_autosend()
-    now = datetime.datetime.now()
+    hour = datetime.datetime.now().hour
+    # users whose rare does not fit this hour are not even selected
+    rares = [how_rare for how_rare, hours in SEND_HOURS.items()
+             if hour in hours]
+    send_list = books_library.get_users_for_autosend(rares)
     for item in send_list:
         try:
             user_id, chat_id = item[0], item[1]
-            how_rare = books_library.get_rare(user_id)
-            if how_rare == '12':
-                send_portion(user_id, chat_id, 0)
-            if (how_rare == '6' and (
-                    now.hour == 5 or now.hour == 7 or now.hour == 9
-                    or now.hour == 11 or now.hour == 13 or now.hour == 15
-                    or now.hour == 17)):
-                send_portion(user_id, chat_id, 0)
-            if how_rare == '4' and (now.hour == 5 or now.hour == 9 or now.hour == 15 or now.hour == 17):
-                send_portion(user_id, chat_id, 0)
-            if how_rare == '2' and (now.hour == 9 or now.hour == 15):
-                send_portion(user_id, chat_id, 0)
-            if how_rare == '1' and now.hour == 9:
-                send_portion(user_id, chat_id, 0)
+            send_portion(user_id, chat_id, 0)
         except Exception as e:
             pass
             logger.error(e)
+    books_library.flush_positions()
     return 0
 
 
-if __name__ == '__main__':
-    scheduler = BackgroundScheduler()
-    scheduler.add_job(auto_send_portions, trigger='cron', hour='5,6,7,8,9,10,11,12,13,14,15,16,17', misfire_grace_time=3600)
-    scheduler.start()
-    if '--prod' in sys.argv:
+def _on_sigterm(signum, frame):
+    # leave through SystemExit, so locks held by interrupted code are
+    # released before positions are flushed below
+    sys.exit(0)
+
+
+def serve():
+    if is_prod:
         while True:
             try:
                 # Start flask server
@@ -497,7 +678,8 @@ if __name__ == '__main__':
                         ssl_context=(
                             config.webhook_ssl_cert,
                             config.webhook_ssl_priv),
-                        debug=False)
+                        debug=False,
+                        threaded=True)  # every update in its own thread
             except Exception as e:
                 logger.error(e)
                 print(e)
@@ -511,3 +693,19 @@ if __name__ == '__main__':
                 logger.error(e)
                 print(e)
                 time.sleep(5)
+
+
+if __name__ == '__main__':
+    # workers are forked before scheduler, server and executor threads
+    # start, the log listener thread is already running but workers never log
+    start_split_pool()
+    scheduler = BackgroundScheduler()
+    scheduler.add_job(auto_send_portions, trigger='cron', hour='5,6,7,8,9,10,11,12,13,14,15,16,17', misfire_grace_time=3600)
+    # positions below the batch size are written at least once a minute
+    scheduler.add_job(books_library.flush_positions, trigger='interval', minutes=1)
+    scheduler.start()
+    signal.signal(signal.SIGTERM, _on_sigterm)
+    try:
+        serve()
+    finally:
+        books_library.flush_positions()
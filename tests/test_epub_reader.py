@@ -31,6 +31,19 @@ class TestEpubReader(unittest.TestCase):
         result = text.split()
         self.assertEqual(result[1], 'II')
 
+    def test_xhtml_entities(self):
+        # xhtml 1.1 doctype with named entities, DTD is never loaded
+        efr = EpubReader(os.path.join(os.getcwd(), 'test_entities.epub'))
+        result = efr.get_next_item_text()
+        self.assertEqual(result, 'c1 \nГлава\xa01. Начало—конец. \n')
+
+    def test_empty_document(self):
+        # empty document gives empty text and reading goes on
+        efr = EpubReader(os.path.join(os.getcwd(), 'test_entities.epub'))
+        efr.get_next_item_text()
+        self.assertEqual(efr.get_next_item_text(), '')
+        self.assertEqual(efr.get_next_item_text(), 'c3 \nГлава 2. \n')
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from txt_file import TxtFile
+
+
+class TestTxtFile(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.file_path = os.path.join(self.folder, 'book.txt')
+        with open(self.file_path, 'w', encoding='utf-8') as f:
+            f.write('Первая строка.\nВторая строка.\nТретья строка.\n')
+        pass
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+        pass
+
+    def test_read_from_start(self):
+        piece, i = TxtFile().read_piece(self.file_path, 0, 20)
+        self.assertEqual(piece, 'Первая строка.\nВторая строка.\n')
+        self.assertEqual(i, 1)
+
+    def test_read_from_pos(self):
+        piece, i = TxtFile().read_piece(self.file_path, 2, 893)
+        self.assertEqual(piece, 'Третья строка.\n')
+        self.assertEqual(i, 2)
+
+    def test_read_unknown_pos(self):
+        # get_pos returns -1 for a book without saved position
+        piece, i = TxtFile().read_piece(self.file_path, -1, 10)
+        self.assertEqual(piece, 'Первая строка.\n')
+        self.assertEqual(i, 0)
+
+    def test_read_after_end(self):
+        piece, i = TxtFile().read_piece(self.file_path, 10, 893)
+        self.assertEqual(piece, '')
+        self.assertEqual(i, 2)
+
+    def test_read_empty_file(self):
+        open(self.file_path, 'w').close()
+        piece, i = TxtFile().read_piece(self.file_path, 0, 893)
+        self.assertEqual(piece, '')
+        self.assertEqual(i, 0)
+
+    def test_read_changed_file(self):
+        TxtFile().read_piece(self.file_path, 0, 893)
+        with open(self.file_path, 'w', encoding='utf-8') as f:
+            f.write('Новая книга.\n')
+        piece, i = TxtFile().read_piece(self.file_path, 0, 893)
+        self.assertEqual(piece, 'Новая книга.\n')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,61 +1,92 @@
 import errno
+import functools
 import re
+
 import nltk
 
-nltk.download('punkt')
-from nltk.tokenize import sent_tokenize
+# [letter or digit] + newline + big letter after
+_SPEC_RE = re.compile(r'(\w)[\n\r\f\v]+([0-9A-ZА-Я])', re.M)
+# letter + dot + big letter and letter after, digits are not touched
+# to keep numbers like 3.14 and lowercase to keep www.example.com,
+# ex: отстраняются от работы.Важнейший принцип работы мозга
+_DOT_RE = re.compile(r'([^\W\d_])\.([A-ZА-ЯЁ][^\W\d_])', re.M)
+_SPACES_RE = re.compile(r'\s+', re.M)
+
+
+@functools.lru_cache(maxsize=None)
+def _ru_tokenizer():
+    # punkt model is loaded once, not on every sent_tokenize call,
+    # and downloaded only if it is not installed yet
+    try:
+        return nltk.data.load('tokenizers/punkt/russian.pickle')
+    except LookupError:
+        nltk.download('punkt', quiet=True)
+        return nltk.data.load('tokenizers/punkt/russian.pickle')
+
+
+_CACHED_TEXT_SIZE = 2048  # only short texts repeat: titles, contents, '* * *'
+
+
+@functools.lru_cache(maxsize=4096)
+def _tokenize_cached(text):
+    return tuple(_ru_tokenizer().tokenize(text))
+
+
+def _tokenize(text):
+    # boilerplate is the same in many books and lines of txt uploads,
+    # so punkt result for short texts is remembered
+    if len(text) <= _CACHED_TEXT_SIZE:
+        return list(_tokenize_cached(text))
+    return _ru_tokenizer().tokenize(text)
 
 
 class TextSeparator(object):
     """Split text to sentences, the way depends on mode value
     If the mode is by_sense, bot try to make sentences even if they finished without a dot
-    Else the bot make sentences just only by newline symbols"""
+    Else the bot make sentences just only by newline symbols
+    One separator can split many texts with split(), text given to the
+    constructor is split lazily on get_sentences()"""
+
+    __slots__ = ('_input_text', '_mode', '_output_sentences')
 
     def __init__(self, in_text='', mode=''):
         """Constructor"""
+        self._input_text = in_text
+        self._mode = mode
+        self._output_sentences = None
+
+    def get_sentences(self):
+        if self._output_sentences is None:
+            self._output_sentences = self.split(self._input_text)
+        return self._output_sentences
+
+    def split(self, text):
         try:
-            self._input_text = in_text
-            self._spit_text_to_sensenses(mode=mode)
+            return self._spit_text_to_sensenses(text)
         except OSError as e:
             if e.errno != errno.EEXIST:
                 raise
-        pass
-
-    def get_sentences(self):
-        return self._output_sentences
+        return []
 
-    def _spit_text_to_sensenses(self, mode):
-        text = self._input_text
-        spec_regex = r'\w[\n\r\f\v]+[0-9A-ZА-Я]'
-        dot_without_space_regex = r'\w\\.\w\w'  # ex: отстраняются от работы.Важнейший принцип работы мозга
-        if mode == 'by_sense':
+    def _spit_text_to_sensenses(self, text):
+        if self._mode == 'by_sense':
             # replace [letter or digit] + newline + big letter after --> '. '
-            # text = re.sub(spec_regex, self._new_strings_to_space, text,
-            #               flags=re.M)
-            # replace [letter or digit] + dot + two letters after --> '. '
-            text = re.sub(dot_without_space_regex, self._add_space_to_dot,
-                          text,
-                          flags=re.M)
+            # text = _SPEC_RE.sub(r'\1. \2', text)
+            # replace letter + dot + big letter and letter after --> '. '
+            text = _DOT_RE.sub(r'\1. \2', text)
             # make one big string from all textlines and then separate them by dot
-            text = re.sub(r'\s+', ' ', text, flags=re.M)
-            self._output_sentences = sent_tokenize(text, 'russian')
+            text = _SPACES_RE.sub(' ', text)
             # todo: auto detect lang
             # todo: limit max sentence size
-        else:
-            self._output_sentences = text.split(sep='\n')
-        pass
-
-    def _new_strings_to_space(self, matchobj):
-        # replace newstring to '. '
-        text_piace = matchobj.group(0)
-        return re.sub(r'[\n\r\f\v]+', '. ', text_piace, flags=re.M)
-
-    def _add_space_to_dot(self, matchobj):
-        # replace '.' to '. '
-        text_piace = matchobj.group(0)
-        return re.sub(r'\\.', '. ', text_piace, flags=re.M)
+            return _tokenize(text)
+        return text.split(sep='\n')
 
     def _print(self):
-        for sent in self._output_sentences:
+        for sent in self.get_sentences():
             print(sent)
         pass
+
+
+def split_sentences(text, mode):
+    # module-level, so worker processes can run it by name
+    return TextSeparator(mode=mode).split(text)
@@ -1,7 +1,41 @@
 import errno
+import functools
 
-from langdetect import detect
 from transliterate import translit, get_available_language_codes
+from transliterate.utils import get_language_pack
+
+_LANG_CODES = frozenset(get_available_language_codes())
+
+
+def _reversed_table(lang):
+    # every reversed rule of the pack maps one char, so they all fit in
+    # one str.translate table with the same result as translit
+    pack = get_language_pack(lang)()
+    table = dict(pack.reversed_translation_table)
+    table.update((ord(char), text) for char, text
+                 in (pack.reversed_pre_processor_mapping or {}).items())
+    table.update(pack.reversed_specific_translation_table or {})
+    return table
+
+
+_RU_TABLE = _reversed_table('ru')
+_UK_CHARS = frozenset('іїєґІЇЄҐ')
+# first and last char of alphabet -> transliteration pack for it
+_ALPHABETS = (
+    ('\u0370', '\u03ff', 'el'),
+    ('\u0530', '\u058f', 'hy'),
+    ('\u10a0', '\u10ff', 'ka'),
+)
+
+
+def _detect(text):
+    # transliteration only needs the alphabet of text, not its language
+    if not _UK_CHARS.isdisjoint(text):
+        return 'uk'
+    for first, last, lang in _ALPHABETS:
+        if any(first <= char <= last for char in text):
+            return lang
+    return 'ru'
 
 
 class TextTransliter(object):
@@ -19,11 +53,16 @@ class TextTransliter(object):
     def _transliterate(self, input_lang):
         # convert from russian to translit
         try:
+            if self._input_text.isascii():
+                # latin text stays as is, no need to guess its alphabet
+                self._output_text = self._input_text
+                return
             if input_lang == '':
-                input_lang = detect(self._input_text)
-            if input_lang not in get_available_language_codes():
-                input_lang = 'ru'
-            self._output_text = translit(self._input_text, input_lang, reversed=True)
+                input_lang = _detect(self._input_text)
+            if input_lang == 'ru' or input_lang not in _LANG_CODES:
+                self._output_text = self._input_text.translate(_RU_TABLE)
+            else:
+                self._output_text = translit(self._input_text, input_lang, reversed=True)
         except OSError as e:
             if e.errno != errno.EEXIST:
                 raise
@@ -31,3 +70,9 @@ class TextTransliter(object):
 
     def get_translitet(self):
         return self._output_text
+
+
+@functools.lru_cache(maxsize=4096)
+def translit_text(input_text):
+    # transliterated text; titles and file names repeat across users
+    return TextTransliter(input_text).get_translitet()
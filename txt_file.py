@@ -1,10 +1,95 @@
 import errno
+import mmap
 import os
+import threading
+from array import array
+from collections import OrderedDict
 from time import gmtime, strftime
 
 import config
 from text_separator import TextSeparator
 
+MMAP_CACHE_SIZE = 32  # how many books keep their mapping between reads
+WRITE_BUFFER_SIZE = 1 << 20  # bytes buffered while book is converted
+_END_LINE = config.end_book_string + '\n'  # last line of every book
+_views = OrderedDict()  # file_path -> _FileView
+_views_lock = threading.Lock()  # reads come from many threads
+
+
+def _line_offsets(mm):
+    # byte offsets where every line of the book starts
+    offsets = array('Q')
+    start, end = 0, len(mm)
+    while start < end:
+        offsets.append(start)
+        stop = mm.find(b'\n', start)
+        if stop == -1:
+            break
+        start = stop + 1
+    return offsets
+
+
+class _FileView(object):
+    """read-only mapping of book file with index of its lines"""
+
+    __slots__ = ('mm', 'offsets', 'mtime_ns', 'size')
+
+    def __init__(self, file_path):
+        fd = os.open(file_path, os.O_RDONLY)
+        try:
+            st = os.fstat(fd)
+            self.mtime_ns, self.size = st.st_mtime_ns, st.st_size
+            if self.size == 0:
+                self.mm = b''  # empty file can not be mapped
+            else:
+                self.mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+                if hasattr(self.mm, 'madvise'):
+                    self.mm.madvise(mmap.MADV_SEQUENTIAL)
+        finally:
+            os.close(fd)
+        self.offsets = _line_offsets(self.mm)
+
+    def is_actual(self, st):
+        return (st.st_mtime_ns, st.st_size) == (self.mtime_ns, self.size)
+
+    def slice_piece(self, pos, piece_size):
+        # lines from pos until piece is longer than piece_size
+        lines_count = len(self.offsets)
+        pos = max(pos, 0)
+        if pos >= lines_count:
+            return '', max(lines_count - 1, 0)
+        lines = []
+        length = 0
+        i = pos
+        while True:
+            stop = self.offsets[i + 1] if i + 1 < lines_count else self.size
+            line = self.mm[self.offsets[i]:stop].decode('utf-8')
+            lines.append(line)
+            length += len(line)
+            if length > piece_size or i + 1 == lines_count:
+                break
+            i += 1
+        return ''.join(lines), i
+
+
+def _open_view(file_path):
+    # reuse mapping and line index while file stays unchanged,
+    # stat and mapping are done outside the lock
+    with _views_lock:
+        view = _views.get(file_path)
+    if view is not None and view.is_actual(os.stat(file_path)):
+        with _views_lock:
+            if file_path in _views:
+                _views.move_to_end(file_path)
+        return view
+    view = _FileView(file_path)
+    with _views_lock:
+        _views[file_path] = view
+        _views.move_to_end(file_path)
+        if len(_views) > MMAP_CACHE_SIZE:
+            _views.popitem(last=False)
+    return view
+
 
 class TxtFile(object):
     """
@@ -14,6 +99,10 @@ class TxtFile(object):
     def __init__(self):
         self._txt_file = ''
         self._txt_file_name = ''
+        self._file_path = ''
+        self._tmp_path = ''
+        self._separator = None
+        self._sent_mode = None
         pass
 
     def create_file(self, folder_for_save, book_title=''):
@@ -24,14 +113,21 @@ class TxtFile(object):
             else:
                 self._txt_file_name = book_title + '.txt'
             file_path = os.path.join(folder_for_save, self._txt_file_name)
-            self._open_file(file_path, mode='w')
+            # book is written aside and appears under its name only when
+            # complete, so readers and parallel conversions never see a part
+            self._file_path = file_path
+            self._tmp_path = '{0}.{1}.{2}.tmp'.format(
+                file_path, os.getpid(), threading.get_ident())
+            self._open_file(self._tmp_path, mode='w')
         except OSError as e:
             if e.errno != errno.EEXIST:
                 raise
         pass
 
     def _open_file(self, file_path, mode):
-        self._txt_file = open(file_path, mode, encoding='utf-8')
+        # books are written in big chunks, so a bigger buffer saves syscalls
+        self._txt_file = open(file_path, mode, encoding='utf-8',
+                              buffering=WRITE_BUFFER_SIZE)
         pass
 
     def _close_file(self):
@@ -39,28 +135,42 @@ class TxtFile(object):
         pass
 
     def write_text(self, text, sent_mode):
-        sentences = TextSeparator(text, mode=sent_mode).get_sentences()
-        for sent in sentences:
-            print(sent, file=self._txt_file)
+        # one separator for all chapters of the book
+        if self._separator is None or self._sent_mode != sent_mode:
+            self._separator = TextSeparator(mode=sent_mode)
+            self._sent_mode = sent_mode
+        self.write_sentences(self._separator.split(text))
+
+    def write_sentences(self, sentences):
+        if sentences:
+            # one line per sentence, written at once
+            self._txt_file.write('\n'.join(sentences))
+            self._txt_file.write('\n')
         pass
 
     def stop_writing(self):
-        print(config.end_book_string, file=self._txt_file)
+        self._txt_file.write(_END_LINE)
         self._close_file()
+        os.replace(self._tmp_path, self._file_path)
+        pass
+
+    def abort(self):
+        # drop unfinished book, its name was never taken
+        if self._txt_file and not self._txt_file.closed:
+            try:
+                self._close_file()
+            except OSError:
+                pass
+        if self._tmp_path:
+            try:
+                os.remove(self._tmp_path)
+            except FileNotFoundError:
+                pass
         pass
 
     def read_piece(self, file_path, pos, piece_size):
         # get no more than 1 line more than max piece size
-        self._open_file(file_path, mode='r')
-        piece = ''
-        i = 0
-        for i, line in enumerate(self._txt_file):
-            if i >= pos:
-                piece += line
-            if len(piece) > piece_size:
-                break
-        self._close_file()
-        return piece, i
+        return _open_view(file_path).slice_piece(pos, piece_size)
 
     def get_txt_file(self):
         return self._txt_file